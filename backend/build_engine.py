@@ -0,0 +1,145 @@
+"""
+Build a TensorRT INT8 engine from the Keras model for ENGINE_FILENAME.
+
+Keras -> SavedModel -> ONNX (tf2onnx) -> TensorRT INT8, calibrated with
+IInt8EntropyCalibrator2 over crack images run through the same preprocess_image()
+as the API. tf2onnx pins protobuf~=3.20 while TensorFlow 2.20 needs protobuf>=5,
+so the ONNX export runs in its own environment (requirements-onnx.txt):
+
+    # serving env (requirements.txt)
+    python convert.py --format savedmodel --input-dtype float32 --output model/saved_model_f32
+    # export env (requirements-onnx.txt)
+    python -m tf2onnx.convert --saved-model model/saved_model_f32 --opset 17 --output model/model.onnx
+    # GPU env (requirements-gpu.txt)
+    python build_engine.py --onnx model/model.onnx --calib-dir data/calib
+
+The exported graph includes the NORMALIZATION affine, so the engine takes raw
+0..255 pixels (as float32; TensorRTModel converts while staging the upload).
+"""
+import argparse
+import logging
+import os
+
+import numpy as np
+import pycuda.driver as cuda
+import tensorrt as trt
+
+from preprocess import list_images, preprocess_image, release_buffer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+INPUT_SHAPE = (224, 224, 3)
+
+
+class CrackCalibrator(trt.IInt8EntropyCalibrator2):
+    """Feeds preprocessed calibration images to TensorRT in fixed-size batches."""
+
+    def __init__(self, image_paths: list, batch_size: int, cache_path: str):
+        super().__init__()
+        self.image_paths = image_paths
+        self.batch_size = batch_size
+        self.cache_path = cache_path
+        self.index = 0
+        self.host_batch = cuda.pagelocked_empty((batch_size,) + INPUT_SHAPE, np.float32)
+        self.dev_batch = cuda.mem_alloc(self.host_batch.nbytes)
+
+    def get_batch_size(self) -> int:
+        return self.batch_size
+
+    def get_batch(self, names):
+        if self.index + self.batch_size > len(self.image_paths):
+            return None
+        for i, path in enumerate(self.image_paths[self.index:self.index + self.batch_size]):
+            with open(path, "rb") as f:
+                x = preprocess_image(f.read())
+            self.host_batch[i] = x[0]
+            release_buffer(x)
+        self.index += self.batch_size
+        cuda.memcpy_htod(self.dev_batch, self.host_batch)
+        return [int(self.dev_batch)]
+
+    def read_calibration_cache(self):
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, "rb") as f:
+                return f.read()
+        return None
+
+    def write_calibration_cache(self, cache):
+        with open(self.cache_path, "wb") as f:
+            f.write(cache)
+
+
+def build_engine(onnx_path: str, calibrator: CrackCalibrator, max_batch: int) -> bytes:
+    trt_logger = trt.Logger(trt.Logger.INFO)
+    builder = trt.Builder(trt_logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, trt_logger)
+    with open(onnx_path, "rb") as f:
+        if not parser.parse(f.read()):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise RuntimeError("Failed to parse ONNX model:\n" + "\n".join(errors))
+
+    config = builder.create_builder_config()
+    config.set_flag(trt.BuilderFlag.INT8)
+    # let layers without an INT8 kernel fall back to FP16 rather than FP32
+    config.set_flag(trt.BuilderFlag.FP16)
+    config.int8_calibrator = calibrator
+
+    input_name = network.get_input(0).name
+    profile = builder.create_optimization_profile()
+    profile.set_shape(
+        input_name,
+        (1,) + INPUT_SHAPE,
+        (max(1, max_batch // 4),) + INPUT_SHAPE,
+        (max_batch,) + INPUT_SHAPE,
+    )
+    config.add_optimization_profile(profile)
+
+    # with dynamic shapes TensorRT calibrates at the profile's opt shape, so give
+    # calibration its own fixed profile matching the calibrator's batches
+    calib_shape = (calibrator.get_batch_size(),) + INPUT_SHAPE
+    calib_profile = builder.create_optimization_profile()
+    calib_profile.set_shape(input_name, calib_shape, calib_shape, calib_shape)
+    config.set_calibration_profile(calib_profile)
+
+    serialized = builder.build_serialized_network(network, config)
+    if serialized is None:
+        raise RuntimeError("TensorRT engine build failed")
+    return bytes(serialized)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calib-dir", required=True, help="directory of representative crack/no_crack images")
+    parser.add_argument("--num-calib", type=int, default=500)
+    parser.add_argument("--calib-batch", type=int, default=16)
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--onnx", default="model/model.onnx", help="ONNX export of the float32 SavedModel")
+    parser.add_argument("--cache", default="model/calib.cache")
+    parser.add_argument("--output", default="model/model.plan")
+    args = parser.parse_args()
+
+    image_paths = list_images(args.calib_dir, args.num_calib)
+    if len(image_paths) < args.calib_batch:
+        raise RuntimeError(f"Need at least {args.calib_batch} calibration images in {args.calib_dir}")
+    logger.info(f"Calibrating with {len(image_paths)} images from {args.calib_dir}")
+
+    if not os.path.exists(args.onnx):
+        raise RuntimeError(f"ONNX model {args.onnx} not found; export it with tf2onnx first (requirements-onnx.txt)")
+
+    cuda.init()
+    cuda_ctx = cuda.Device(0).make_context()
+    try:
+        calibrator = CrackCalibrator(image_paths, args.calib_batch, args.cache)
+        engine = build_engine(args.onnx, calibrator, args.max_batch)
+    finally:
+        cuda_ctx.pop()
+
+    with open(args.output, "wb") as f:
+        f.write(engine)
+    logger.info(f"Saved TensorRT engine to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
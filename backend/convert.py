@@ -0,0 +1,104 @@
+"""
+Convert the Keras model to a full-integer INT8 TFLite model for TFLITE_FILENAME,
+or export it as a SavedModel directory for MODEL_FILENAME.
+
+    python convert.py --calib-dir data/calib
+    python convert.py --format savedmodel
+    python convert.py --format savedmodel --input-dtype float32 --output model/saved_model_f32
+
+Weights and activations are quantized against a representative dataset of crack
+images run through the same preprocess_image() as the API; the input and output
+tensors are int8 so the interpreter runs XNNPACK's int8 kernels end to end.
+The NORMALIZATION affine is part of the converted graph, so the input
+quantization covers raw 0..255 pixels and TFLiteModel only needs a lookup table.
+
+The SavedModel carries the same "serve" graph and loads without Keras
+rebuilding the layers from their config. It takes uint8 pixels for the API;
+a float32 one is the starting point for the ONNX/TensorRT build (build_engine.py).
+"""
+import argparse
+import logging
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+from preprocess import fuse_normalization, list_images, preprocess_image, release_buffer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def representative_dataset(image_paths: list):
+    def generate():
+        for path in image_paths:
+            with open(path, "rb") as f:
+                x = preprocess_image(f.read())
+            sample = x.astype(np.float32)
+            release_buffer(x)
+            yield [sample]
+    return generate
+
+
+def convert(model_path: str, image_paths: list) -> bytes:
+    model = tf.keras.models.load_model(model_path)
+    serve_fn = tf.function(fuse_normalization(model)).get_concrete_function(
+        tf.TensorSpec((None, 224, 224, 3), tf.float32)
+    )
+    # freeze the weights so the normalization constants fold into the graph
+    serve_fn = convert_variables_to_constants_v2(serve_fn)
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([serve_fn])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset(image_paths)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+    return converter.convert()
+
+
+def export_savedmodel(model_path: str, output_dir: str, input_dtype: str = "uint8") -> None:
+    model = tf.keras.models.load_model(model_path)
+    module = tf.Module()
+    module.model = model  # tracks the weights
+    module.serve = tf.function(
+        fuse_normalization(model),
+        input_signature=[tf.TensorSpec((None, 224, 224, 3), tf.as_dtype(input_dtype), name="input")],
+    )
+    tf.saved_model.save(module, output_dir, signatures={"serving_default": module.serve})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.environ.get("MODEL_FILENAME", "model/efficientNetB0_augment.keras"))
+    parser.add_argument("--format", choices=("tflite", "savedmodel"), default="tflite")
+    parser.add_argument("--calib-dir", help="directory of representative crack/no_crack images (tflite)")
+    parser.add_argument("--num-calib", type=int, default=500)
+    parser.add_argument("--input-dtype", choices=("uint8", "float32"), default="uint8",
+                        help="SavedModel input dtype; float32 for the ONNX/TensorRT build")
+    parser.add_argument("--output", help="default: model/model.int8.tflite or model/saved_model")
+    args = parser.parse_args()
+
+    if args.format == "savedmodel":
+        output = args.output or "model/saved_model"
+        export_savedmodel(args.model, output, args.input_dtype)
+        logger.info(f"Saved SavedModel to {output}")
+        return
+
+    if not args.calib_dir:
+        parser.error("--calib-dir is required for --format tflite")
+    args.output = args.output or "model/model.int8.tflite"
+
+    image_paths = list_images(args.calib_dir, args.num_calib)
+    if not image_paths:
+        raise RuntimeError(f"No calibration images found in {args.calib_dir}")
+    logger.info(f"Calibrating with {len(image_paths)} images from {args.calib_dir}")
+
+    tflite_model = convert(args.model, image_paths)
+    with open(args.output, "wb") as f:
+        f.write(tflite_model)
+    logger.info(f"Saved INT8 TFLite model to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
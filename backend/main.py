@@ -3,15 +3,93 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from starlette.concurrency import run_in_threadpool
 import numpy as np
-from PIL import Image
-import tensorflow as tf
-import io
+import asyncio
+import concurrent.futures
+import json
 import os
 import logging
-from tensorflow.keras.applications.efficientnet import preprocess_input as eff_preprocess
+import time
+from typing import Optional
+from preprocess import ImageTooLarge, fuse_normalization, preprocess_image, release_buffer
+
+def physical_cores() -> int:
+    """Physical cores this process may run on (hyperthread siblings counted once)."""
+    cpus = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else range(os.cpu_count() or 1)
+    cores = set()
+    for cpu in cpus:
+        try:
+            topology = f"/sys/devices/system/cpu/cpu{cpu}/topology"
+            with open(f"{topology}/physical_package_id") as f_pkg, open(f"{topology}/core_id") as f_core:
+                cores.add((f_pkg.read().strip(), f_core.read().strip()))
+        except OSError:
+            return len(cpus)
+    return max(1, len(cores))
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """CPUs granted by the cgroup CPU quota (docker --cpus), or None if unlimited."""
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1; a quota of -1 means unlimited
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f_quota, \
+                open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f_period:
+            quota, period = int(f_quota.read()), int(f_period.read())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+def available_cores() -> int:
+    """physical_cores(), clamped to the container's CPU quota."""
+    cores = physical_cores()
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cores = min(cores, max(1, int(limit)))
+    return cores
+
+# Optional TensorRT engine built by build_engine.py; takes precedence over the Keras model
+engine_path = os.environ.get("ENGINE_FILENAME")
+TRT_STREAMS = int(os.environ.get("TRT_STREAMS", "2"))
+
+# Batches allowed in flight at once. The TensorRT backend overlaps one batch's
+# copies with another's compute across its CUDA streams; the CPU backends run one at a time.
+PIPELINE_DEPTH = int(os.environ.get("PIPELINE_DEPTH", str(TRT_STREAMS if engine_path else 1)))
+
+# CPU threading for TensorFlow/oneDNN (and the TFLite interpreter); the env vars must
+# be set before TensorFlow loads.
+# The available cores are split across the batches allowed in flight (PIPELINE_DEPTH),
+# and inter-op parallelism is off, so concurrent inference calls do not oversubscribe
+# the cores or thrash each other's caches.
+INTRA_OP_THREADS = int(os.environ.get(
+    "INTRA_OP_THREADS", str(max(1, available_cores() // PIPELINE_DEPTH))
+))
+os.environ.setdefault("OMP_NUM_THREADS", str(INTRA_OP_THREADS))
+os.environ.setdefault("TF_NUM_INTRAOP_THREADS", str(INTRA_OP_THREADS))
+os.environ.setdefault("TF_NUM_INTEROP_THREADS", "1")
+# only read by OpenMP-built MKL/oneDNN
+os.environ.setdefault("KMP_AFFINITY", "granularity=fine,compact,1,0")
+
+def load_tensorflow():
+    """
+    Import TensorFlow with the thread pools sized above. Only the Keras and
+    SavedModel backends call this, so TFLite can run on tflite_runtime alone.
+    """
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(INTRA_OP_THREADS)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    return tf
+
+# XLA-compile the serving graph. Off by default: on CPU XLA bypasses oneDNN and
+# ran EfficientNetB0 ~10x slower in testing; worth trying on GPU.
+XLA_JIT = os.environ.get("XLA_JIT", "0") == "1"
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+logger.info(f"Intra-op threads: {INTRA_OP_THREADS}")
 
 app = FastAPI(
     title="Surface Crack Detection API",
@@ -32,57 +110,227 @@ app.add_middleware(
 class_names = os.environ.get("CLASS_NAMES", "no_crack,crack").split(",")
 THRESHOLD = float(os.environ.get("THRESHOLD", "0.5"))
 
-# Load Keras model from environment or default filename
+# Largest accepted upload; bigger files are rejected with 413 before decoding
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+
+# Keras dtype policy for the served model: float32 (default), float16, bfloat16,
+# mixed_float16 or mixed_bfloat16. Halves weight traffic on GPUs / bf16-capable CPUs;
+# on plain AVX2/AVX-512 CPUs TF has no fast fp16 kernels, so leave it at float32 there.
+PRECISION = os.environ.get("PRECISION", "float32")
+
+# layers that stay float32 so normalization and the thresholded sigmoid are unchanged
+FLOAT32_LAYERS = {"InputLayer", "Rescaling", "Normalization"}
+
+def apply_precision(model: "tf.keras.Model", policy: str) -> "tf.keras.Model":
+    """
+    Rebuild model with every layer (nested ones included) under policy,
+    except FLOAT32_LAYERS and the output layer, and copy the weights over.
+    """
+    output_layer = model.layers[-1].name
+
+    def set_policy(node):
+        if isinstance(node, dict):
+            class_name = node.get("class_name", "")
+            config = node.get("config")
+            # "__keras_tensor__" entries also carry a dtype; only layer configs get the policy
+            if (isinstance(config, dict) and "dtype" in config and not class_name.startswith("__")
+                    and class_name not in FLOAT32_LAYERS and config.get("name") != output_layer):
+                config["dtype"] = policy
+            for value in node.values():
+                set_policy(value)
+        elif isinstance(node, list):
+            for value in node:
+                set_policy(value)
+
+    config = json.loads(model.to_json())
+    set_policy(config)
+    converted = tf.keras.models.model_from_json(json.dumps(config))
+    converted.set_weights(model.get_weights())
+
+    # Normalization derives its mean/variance tensors from the weights only in
+    # finalize_state(), which load_model calls but set_weights does not
+    def finalize(layer):
+        if isinstance(layer, tf.keras.layers.Normalization):
+            layer.finalize_state()
+        for sub in getattr(layer, "layers", []):
+            finalize(sub)
+    finalize(converted)
+    return converted
+
+# Optional INT8 TFLite model built by convert.py (CPU, XNNPACK); next in precedence
+tflite_path = os.environ.get("TFLITE_FILENAME")
+
+# Load Keras model from environment or default filename; a directory is taken as
+# a SavedModel exported by `convert.py --format savedmodel`
 model_path = os.environ.get("MODEL_FILENAME", "model/efficientNetB0_augment.keras")
-if not os.path.exists(model_path):
-    logger.error(f"Model file {model_path} not found")
-    raise RuntimeError(f"Model file {model_path} not found")
-logger.info(f"Loading model from {model_path}…")
-model = tf.keras.models.load_model(model_path)
+
+if engine_path:
+    if not os.path.exists(engine_path):
+        logger.error(f"Engine file {engine_path} not found")
+        raise RuntimeError(f"Engine file {engine_path} not found")
+    from trt_engine import TensorRTModel
+    logger.info(f"Loading TensorRT engine from {engine_path}…")
+    model = TensorRTModel(engine_path, num_streams=TRT_STREAMS)
+    infer = model.predict
+elif tflite_path:
+    if not os.path.exists(tflite_path):
+        logger.error(f"TFLite model {tflite_path} not found")
+        raise RuntimeError(f"TFLite model {tflite_path} not found")
+    from tflite_engine import TFLiteModel
+    logger.info(f"Loading TFLite model from {tflite_path}…")
+    model = TFLiteModel(tflite_path, num_threads=INTRA_OP_THREADS)
+    infer = model.predict
+elif os.path.isdir(model_path):
+    if PRECISION != "float32":
+        raise RuntimeError("PRECISION is only supported for .keras models")
+    logger.info(f"Loading SavedModel from {model_path}…")
+    tf = load_tensorflow()
+    # restores the traced uint8 graph and its variables directly, without
+    # rebuilding the Keras layers
+    model = tf.saved_model.load(model_path)
+    # restored objects have no Keras output_shape; read it off the signature
+    model.output_shape = tuple(model.serve.get_concrete_function().structured_outputs.shape)
+    serve_fn = tf.function(
+        model.serve,
+        input_signature=[tf.TensorSpec((None, 224, 224, 3), tf.uint8)],
+        jit_compile=XLA_JIT,
+    )
+
+    def infer(x: np.ndarray) -> np.ndarray:
+        return serve_fn(x).numpy()
+else:
+    if not os.path.exists(model_path):
+        logger.error(f"Model file {model_path} not found")
+        raise RuntimeError(f"Model file {model_path} not found")
+    logger.info(f"Loading model from {model_path}…")
+    tf = load_tensorflow()
+    model = tf.keras.models.load_model(model_path)
+    if PRECISION != "float32":
+        logger.info(f"Converting model to {PRECISION}…")
+        model = apply_precision(model, PRECISION)
+
+    # model.predict() retraces for every new batch size and rebuilds its input
+    # pipeline per call; a graph with a dynamic batch dimension serves any batch.
+    # It takes the raw uint8 pixels and does the cast + normalization itself.
+    serve_fn = tf.function(
+        fuse_normalization(model),
+        input_signature=[tf.TensorSpec((None, 224, 224, 3), tf.uint8)],
+        jit_compile=XLA_JIT,
+    )
+
+    def infer(x: np.ndarray) -> np.ndarray:
+        return serve_fn(x).numpy()
 logger.info("Model loaded successfully.")
 
-IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
-IMAGENET_STD  = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+# Warm up before accepting traffic: the first call traces/optimizes the graph and
+# sets up the backend's kernels, which would otherwise land on the first request
+warmup_start = time.perf_counter()
+infer(np.zeros((1, 224, 224, 3), dtype=np.uint8))
+logger.info(f"Warm-up inference took {time.perf_counter() - warmup_start:.2f}s")
+
+# The output layout is fixed per model, so pick the postprocess once here
+# (and fail at startup, not per request, if it is unsupported)
+OUTPUT_DIM = model.output_shape[-1]
+if OUTPUT_DIM == 1:
+    def postprocess(preds: np.ndarray) -> tuple:
+        """binary sigmoid: probability of positive class (crack)"""
+        p_positive = float(preds[0, 0])
+        if p_positive >= THRESHOLD:
+            return class_names[1], p_positive  # crack
+        return class_names[0], 1.0 - p_positive  # no_crack
+elif OUTPUT_DIM == 2:
+    def postprocess(preds: np.ndarray) -> tuple:
+        """softmax: choose higher probability between two classes"""
+        # two scalars: a compare is cheaper than an argmax dispatch
+        p0, p1 = float(preds[0, 0]), float(preds[0, 1])
+        if p0 >= p1:
+            return class_names[0], p0
+        return class_names[1], p1
+else:
+    raise RuntimeError(f"Unsupported number of classes: {OUTPUT_DIM}")
+
+# Dynamic batching: concurrent requests are coalesced into one infer() call on the backend
+MAX_BATCH = int(os.environ.get("MAX_BATCH", "32"))
+BATCH_TIMEOUT_US = int(os.environ.get("BATCH_TIMEOUT_US", "5000"))
+if engine_path:
+    MAX_BATCH = min(MAX_BATCH, model.max_batch)
+
+# Inference gets its own threads, one per in-flight batch, so it never queues
+# behind (or oversubscribes cores with) the preprocessing in Starlette's threadpool
+inference_pool = concurrent.futures.ThreadPoolExecutor(max_workers=PIPELINE_DEPTH, thread_name_prefix="inference")
+
+# (tensor, future) pairs waiting for the batch worker
+batch_queue: asyncio.Queue = asyncio.Queue()
+# one reusable batch buffer per in-flight batch; taking one is what bounds the pipeline.
+# The TensorRT backend hands out page-locked buffers, so batches are assembled
+# where the host-to-device DMA reads them.
+empty_batch = getattr(model, "empty_batch", lambda: np.empty((MAX_BATCH, 224, 224, 3), dtype=np.uint8))
+free_batch_buffers: asyncio.Queue = asyncio.Queue()
+for _ in range(PIPELINE_DEPTH):
+    free_batch_buffers.put_nowait(empty_batch())
+# strong references so running batches are not garbage-collected
+running_batches: set = set()
 
-def preprocess_image(image_bytes: bytes) -> np.ndarray:
+async def run_batch(items: list, buffer: np.ndarray) -> None:
+    """Run one collected batch and resolve each caller's future with its row."""
+    try:
+        batch = buffer[:len(items)]
+        try:
+            np.concatenate([x for x, _ in items], out=batch)
+        finally:
+            # the request tensors are only read here, even for callers that have
+            # since gone away, so this is where they go back to the ring
+            for x, _ in items:
+                release_buffer(x)
+        # run infer() on the inference pool to avoid blocking the event loop
+        preds = np.asarray(await asyncio.get_running_loop().run_in_executor(inference_pool, infer, batch))
+    except Exception as e:
+        logger.exception("Batch prediction failed")
+        for _, fut in items:
+            if not fut.done():
+                fut.set_exception(e)
+        return
+    finally:
+        free_batch_buffers.put_nowait(buffer)
+
+    for i, (_, fut) in enumerate(items):
+        # the caller may have gone away (client disconnect cancels the future)
+        if not fut.done():
+            fut.set_result(preds[i:i + 1])
+
+async def batch_worker() -> None:
     """
-    ปรับภาพให้สอดคล้องกับ PyTorch transforms:
-    Resize(shorter side=256) -> CenterCrop(224) -> Grayscale(3) -> Normalize.
+    Once a batch buffer is free, take the first waiting request, then keep
+    collecting until MAX_BATCH items or BATCH_TIMEOUT_US have passed, and
+    start them as one batch without waiting for earlier batches to finish.
     """
-    # โหลดและแปลงภาพเป็น RGB
-    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-
-    # Resize: ย่อขนาดโดยรักษาอัตราส่วนให้ด้านสั้นเป็น 256 พิกเซล
-    short_side = 224
-    w, h = img.size
-    if w < h:
-        new_w, new_h = short_side, int(h * short_side / w)
-    else:
-        new_h, new_w = short_side, int(w * short_side / h)
-    img = img.resize((new_w, new_h), Image.BILINEAR)
-
-    # CenterCrop 224x224
-    left = (img.width - 224) / 2
-    top = (img.height - 224) / 2
-    right = left + 224
-    bottom = top + 224
-    img = img.crop((left, top, right, bottom))
-
-    # Grayscale to 3-channel: แปลงเป็นภาพขาวดำหนึ่งช่องแล้วซ้ำเป็น 3 ช่อง
-    gray = img.convert("L")
-    img = Image.merge("RGB", (gray, gray, gray))
-
-    # ToTensor + Normalize: แปลงเป็นอาร์เรย์ float32 ช่วง [0,1]
-    # x = np.asarray(img, dtype=np.float32) / 255.0
-    # # Normalize per-channel ตาม ImageNet:contentReference[oaicite:1]{index=1}
-    # x = (x - IMAGENET_MEAN) / IMAGENET_STD
-
-    # For EfficientNet
-    x = np.asarray(img, dtype=np.float32)             # 0..255
-    x = eff_preprocess(x)                             # for EfficientNet
-
-    # เพิ่มมิติ batch (1, 224, 224, 3)
-    return x[None, ...].astype(np.float32)
+    loop = asyncio.get_running_loop()
+    timeout = BATCH_TIMEOUT_US / 1_000_000
+    while True:
+        buffer = await free_batch_buffers.get()
+        items = [await batch_queue.get()]
+        deadline = loop.time() + timeout
+        while len(items) < MAX_BATCH:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(batch_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        task = asyncio.create_task(run_batch(items, buffer))
+        running_batches.add(task)
+        task.add_done_callback(running_batches.discard)
+
+@app.on_event("startup")
+async def start_batch_worker() -> None:
+    app.state.batch_worker = asyncio.create_task(batch_worker())
+
+@app.on_event("shutdown")
+async def stop_batch_worker() -> None:
+    app.state.batch_worker.cancel()
+    inference_pool.shutdown(wait=False, cancel_futures=True)
 
 class PredictionResponse(BaseModel):
     label: str
@@ -103,32 +351,30 @@ async def predict(file: UploadFile = File(...)) -> PredictionResponse:
         raise HTTPException(status_code=400, detail="No file provided.")
     if file.content_type and not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="Only image files are supported.")
+    if file.content_type == "image/gif":
+        raise HTTPException(status_code=415, detail="GIF images are not supported.")
 
-    img_bytes = await file.read()
-    x = preprocess_image(img_bytes)
+    too_large = HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} bytes.")
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise too_large
+    # bounded read: never buffer more than MAX_UPLOAD_BYTES + 1 even if size is unknown
+    img_bytes = await file.read(MAX_UPLOAD_BYTES + 1)
+    if len(img_bytes) > MAX_UPLOAD_BYTES:
+        raise too_large
+    try:
+        # decode/resize/crop release the GIL, so requests preprocess in parallel
+        x = await run_in_threadpool(preprocess_image, img_bytes)
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    # run predict in a thread pool to avoid blocking the event loop
-    preds = await run_in_threadpool(model.predict, x, verbose=0)
-
-    preds = np.asarray(preds)
-    if preds.ndim != 2 or preds.shape[0] != 1:
-        raise HTTPException(status_code=500, detail=f"Unexpected prediction shape: {preds.shape}")
-
-    if preds.shape[1] == 1:
-        # binary sigmoid: probability of positive class (crack)
-        p_positive = float(preds[0, 0])
-        if p_positive >= THRESHOLD:
-            label = class_names[1]  # crack
-            prob = p_positive
-        else:
-            label = class_names[0]  # no_crack
-            prob = 1.0 - p_positive
-    elif preds.shape[1] == 2:
-        # softmax: choose higher probability between two classes
-        idx = int(np.argmax(preds[0]))
-        label = class_names[idx]
-        prob = float(preds[0, idx])
-    else:
-        raise HTTPException(status_code=500, detail=f"Unsupported number of classes: {preds.shape[1]}")
+    # hand off to the batch worker and wait for this request's row;
+    # run_batch returns x to the ring once it has been copied into the batch
+    fut = asyncio.get_running_loop().create_future()
+    batch_queue.put_nowait((x, fut))
+    preds = await fut
 
+    # preds is this request's (1, OUTPUT_DIM) row of the batch's ndarray
+    label, prob = postprocess(preds)
     return PredictionResponse(label=label, prob=prob)
@@ -0,0 +1,163 @@
+import glob
+import os
+import queue
+
+# Largest accepted decoded image (width * height). Compressed size says nothing
+# about this: a few hundred KB of PNG can expand to gigabytes. The default is
+# Pillow's MAX_IMAGE_PIXELS; OpenCV reads its own copy of the limit when it loads,
+# so it is set before the import and covers every format cv2 decodes.
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", "89478485"))
+os.environ["OPENCV_IO_MAX_IMAGE_PIXELS"] = str(MAX_IMAGE_PIXELS)
+
+import cv2
+import numpy as np
+
+# libjpeg-turbo SIMD decoder for JPEG uploads; other formats (and a missing
+# libturbojpeg) fall back to cv2.imdecode
+try:
+    from turbojpeg import TurboJPEG, TJPF_GRAY
+    _turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbojpeg = None
+
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD  = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+# Per-channel affine applied to 0..255 pixels: x * SCALE + BIAS.
+# EfficientNet models carry their own Rescaling/Normalization layers (Keras'
+# efficientnet.preprocess_input is a pass-through), so they take raw pixels;
+# "imagenet" is the torchvision ToTensor + Normalize path.
+# The affine runs inside the served graph (fuse_normalization), not per request on the CPU.
+NORMALIZATION = os.environ.get("NORMALIZATION", "efficientnet")
+if NORMALIZATION == "imagenet":
+    SCALE = ((1.0 / 255.0) / IMAGENET_STD).astype(np.float32)
+    BIAS = (-IMAGENET_MEAN / IMAGENET_STD).astype(np.float32)
+elif NORMALIZATION == "efficientnet":
+    SCALE = np.ones(3, dtype=np.float32)
+    BIAS = np.zeros(3, dtype=np.float32)
+else:
+    raise RuntimeError(f"Unknown NORMALIZATION {NORMALIZATION!r}; expected 'efficientnet' or 'imagenet'")
+
+def fuse_normalization(model):
+    """
+    Wrap a Keras model so it takes raw 0..255 pixels (uint8 or float) and applies
+    the NORMALIZATION affine in-graph, where it is folded into the model's own
+    first layers. Trace the result with tf.function.
+    """
+    import tensorflow as tf  # only the model-building side needs TensorFlow
+
+    scale = tf.constant(SCALE)
+    bias = tf.constant(BIAS)
+
+    def call(x):
+        x = tf.cast(x, tf.float32)
+        if NORMALIZATION != "efficientnet":
+            x = x * scale + bias
+        return model(x, training=False)
+    return call
+
+# Ring of reusable uint8 (1, 224, 224, 3) input tensors: preprocess_image() takes one,
+# the caller hands it back with release_buffer() once inference is done.
+# An empty ring falls back to a fresh allocation instead of blocking.
+BUFFER_COUNT = 2 * (os.cpu_count() or 1)
+_buffers: queue.Queue = queue.Queue(maxsize=BUFFER_COUNT)
+for _ in range(BUFFER_COUNT):
+    _buffers.put(np.empty((1, 224, 224, 3), dtype=np.uint8))
+
+def release_buffer(x: np.ndarray) -> None:
+    try:
+        _buffers.put_nowait(x)
+    except queue.Full:
+        pass
+
+class ImageTooLarge(ValueError):
+    """The image's dimensions exceed MAX_IMAGE_PIXELS."""
+
+def _jpeg_scaling_factor(w: int, h: int, short_side: int) -> tuple:
+    """Smallest libjpeg-turbo scaling factor that keeps the short side >= short_side."""
+    best = (1, 1)
+    for num, denom in _turbojpeg.scaling_factors:
+        # TurboJPEG rounds scaled dimensions up
+        if num < denom and -(-min(w, h) * num // denom) >= short_side and num * best[1] < best[0] * denom:
+            best = (num, denom)
+    return best
+
+def _decode_gray(image_bytes: bytes, short_side: int) -> np.ndarray:
+    """
+    Decode straight to 8-bit BT.601 luma (H, W) so the color planes are never
+    materialized. JPEGs go through TurboJPEG, which emits the Y plane without
+    color conversion and decodes directly at a reduced scale when the source is
+    much larger than short_side; OpenCV converts everything else in its SIMD loop.
+    """
+    if not image_bytes:
+        raise ValueError("Could not decode image.")
+    # Pillow read GIFs; the pinned OpenCV 4.10 does not (4.11+ would), so refuse them
+    # outright rather than depend on the installed OpenCV
+    if image_bytes[:4] == b"GIF8":
+        raise ValueError("GIF images are not supported.")
+    if _turbojpeg is not None and image_bytes[:2] == b"\xff\xd8":
+        try:
+            w, h, _, _ = _turbojpeg.decode_header(image_bytes)
+            if w * h > MAX_IMAGE_PIXELS:
+                raise ImageTooLarge(f"Image exceeds {MAX_IMAGE_PIXELS} pixels.")
+            return _turbojpeg.decode(
+                image_bytes, pixel_format=TJPF_GRAY, scaling_factor=_jpeg_scaling_factor(w, h, short_side)
+            )[..., 0]
+        except OSError:
+            pass  # corrupt or unusual JPEG; let OpenCV try
+    # ไม่หมุนตาม EXIF เหมือน PIL.Image.open เดิม
+    try:
+        gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION)
+    except cv2.error as e:
+        # OpenCV checks the header against OPENCV_IO_MAX_IMAGE_PIXELS before allocating
+        if "CV_IO_MAX_IMAGE_PIXELS" in str(e):
+            raise ImageTooLarge(f"Image exceeds {MAX_IMAGE_PIXELS} pixels.") from e
+        raise ValueError("Could not decode image.") from e
+    if gray is None:
+        raise ValueError("Could not decode image.")
+    return gray
+
+def preprocess_image(image_bytes: bytes) -> np.ndarray:
+    """
+    ปรับภาพให้สอดคล้องกับ PyTorch transforms:
+    Resize(shorter side=224) -> CenterCrop(224) -> Grayscale(3); Normalize is
+    fused into the served model, so this returns raw uint8 pixels.
+    Returns a buffer from the ring; pass it to release_buffer() when done.
+    Raises ValueError if the bytes cannot be decoded as an image, and its
+    ImageTooLarge subclass if the image has more than MAX_IMAGE_PIXELS pixels.
+    """
+    short_side = 224
+
+    # Grayscale: ถอดรหัสเป็นภาพขาวดำช่องเดียวตั้งแต่แรก (resize/crop ทำงานบน 1 ช่องแทน 3)
+    gray = _decode_gray(image_bytes, short_side)
+
+    # Resize(shorter side=224) + CenterCrop(224) รวมเป็นขั้นเดียว: ครอปสี่เหลี่ยมจัตุรัส
+    # กลางภาพจากต้นฉบับ (NumPy view) แล้วย่อเหลือ 224x224 so pixels outside the crop
+    # are never resampled
+    h, w = gray.shape
+    side = min(w, h)
+    top = (h - side) // 2
+    left = (w - side) // 2
+    gray = gray[top:top + side, left:left + side]
+    if side != 224:
+        # INTER_AREA when shrinking matches PIL's antialiased BILINEAR far better than INTER_LINEAR
+        interpolation = cv2.INTER_AREA if side > 224 else cv2.INTER_LINEAR
+        gray = cv2.resize(gray, (224, 224), interpolation=interpolation)
+
+    # Grayscale(3): เขียนค่าเทาเดียวลงทั้ง 3 ช่อง (uint8, ช่วง 0..255)
+    try:
+        x = _buffers.get_nowait()
+    except queue.Empty:
+        x = np.empty((1, 224, 224, 3), dtype=np.uint8)
+    # OpenCV's SIMD loop (~7 µs, releases the GIL) is far faster than a broadcast np.copyto
+    cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB, dst=x[0])
+    return x
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+def list_images(directory: str, limit: int) -> list:
+    """First limit image files under directory (recursive, sorted), for calibration."""
+    return sorted(
+        p for p in glob.glob(os.path.join(directory, "**", "*"), recursive=True)
+        if p.lower().endswith(IMAGE_EXTENSIONS)
+    )[:limit]
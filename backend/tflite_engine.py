@@ -0,0 +1,61 @@
+import threading
+
+import numpy as np
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:  # full TensorFlow ships the same interpreter
+    import tensorflow as tf
+    Interpreter = tf.lite.Interpreter
+
+
+class TFLiteModel:
+    """
+    Serves a TFLite model (see convert.py). XNNPACK is the interpreter's default
+    CPU delegate and covers the int8 conv kernels, so nothing is loaded explicitly.
+    Quantized inputs/outputs are converted with the model's own scale/zero point;
+    uint8 pixels from preprocess_image() go through a 256-entry lookup table.
+    """
+
+    def __init__(self, model_path: str, num_threads: int = None):
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        input_details = self.interpreter.get_input_details()[0]
+        output_details = self.interpreter.get_output_details()[0]
+        self._input_index = input_details["index"]
+        self._output_index = output_details["index"]
+        self._input_dtype = input_details["dtype"]
+        input_scale, self._input_zero_point = input_details["quantization"]
+        self._input_inv_scale = 1.0 / input_scale if input_scale else None
+        # every possible uint8 pixel, quantized once
+        self._input_lut = self._quantize(np.arange(256, dtype=np.float32))
+        self._output_scale, self._output_zero_point = output_details["quantization"]
+        self.output_shape = tuple(output_details["shape"])
+        self._batch_size = None
+        # the interpreter is not thread-safe
+        self._lock = threading.Lock()
+
+    def _quantize(self, x: np.ndarray) -> np.ndarray:
+        if x.dtype == np.uint8:
+            return self._input_lut[x]
+        if self._input_inv_scale is None:
+            return x.astype(self._input_dtype, copy=False)
+        info = np.iinfo(self._input_dtype)
+        q = x * np.float32(self._input_inv_scale) + np.float32(self._input_zero_point)
+        np.rint(q, out=q)
+        np.clip(q, info.min, info.max, out=q)
+        return q.astype(self._input_dtype)
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        """uint8 (N, 224, 224, 3) raw pixels -> float32 (N, classes), dequantized."""
+        with self._lock:
+            if x.shape[0] != self._batch_size:
+                # batch dimension follows the batcher; reallocate only when it changes
+                self.interpreter.resize_tensor_input(self._input_index, list(x.shape))
+                self.interpreter.allocate_tensors()
+                self._batch_size = x.shape[0]
+            self.interpreter.set_tensor(self._input_index, self._quantize(x))
+            self.interpreter.invoke()
+            y = self.interpreter.get_tensor(self._output_index)
+        if self._output_scale:
+            return (y.astype(np.float32) - self._output_zero_point) * np.float32(self._output_scale)
+        return y.astype(np.float32, copy=False)
@@ -0,0 +1,114 @@
+import queue
+
+import numpy as np
+import pycuda.driver as cuda
+import tensorrt as trt
+
+
+class _StreamSlot:
+    """One execution context with its own CUDA stream, completion event and I/O buffers."""
+
+    def __init__(self, engine, input_name: str, output_name: str, in_shape: tuple, out_shape: tuple):
+        self.context = engine.create_execution_context()
+        self.host_in = cuda.pagelocked_empty(in_shape, np.float32)
+        self.host_out = cuda.pagelocked_empty(out_shape, np.float32)
+        self.dev_in = cuda.mem_alloc(self.host_in.nbytes)
+        self.dev_out = cuda.mem_alloc(self.host_out.nbytes)
+        self.stream = cuda.Stream()
+        self.done = cuda.Event()
+        self.context.set_tensor_address(input_name, int(self.dev_in))
+        self.context.set_tensor_address(output_name, int(self.dev_out))
+
+
+class TensorRTModel:
+    """
+    Serves a serialized TensorRT engine (see build_engine.py).
+    predict() takes a uint8 (N, 224, 224, 3) batch of raw pixels and widens it to
+    float32 as it is written into the pinned upload buffer; batches assembled in a
+    buffer from empty_batch() (float32, same layout) skip that staging copy entirely.
+    Keeps num_streams slots so that, with that many batches in flight, the H2D copy
+    of one batch overlaps the compute of another; buffers are allocated once.
+    """
+
+    def __init__(self, engine_path: str, num_streams: int = 2):
+        cuda.init()
+        # predict() is called from threadpool workers, so the context is pushed per call
+        self._cuda_ctx = cuda.Device(0).retain_primary_context()
+        self._cuda_ctx.push()
+        try:
+            self._trt_logger = trt.Logger(trt.Logger.WARNING)
+            runtime = trt.Runtime(self._trt_logger)
+            with open(engine_path, "rb") as f:
+                self.engine = runtime.deserialize_cuda_engine(f.read())
+            if self.engine is None:
+                raise RuntimeError(f"Failed to deserialize TensorRT engine {engine_path}")
+
+            names = [self.engine.get_tensor_name(i) for i in range(self.engine.num_io_tensors)]
+            self.input_name = next(n for n in names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.INPUT)
+            self.output_name = next(n for n in names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.OUTPUT)
+
+            in_shape = tuple(self.engine.get_tensor_shape(self.input_name))
+            if in_shape[0] == -1:
+                # dynamic batch: size buffers for the optimization profile's max shape
+                in_shape = tuple(self.engine.get_tensor_profile_shape(self.input_name, 0)[2])
+            self.max_batch = in_shape[0]
+            self._in_shape = in_shape
+            # (start, end) host addresses of buffers handed out by empty_batch()
+            self._pinned_ranges = []
+            # (-1, classes) like Keras' model.output_shape
+            self.output_shape = tuple(self.engine.get_tensor_shape(self.output_name))
+            out_shape = (self.max_batch,) + self.output_shape[1:]
+
+            self.num_streams = num_streams
+            self._slots = queue.Queue()
+            for _ in range(num_streams):
+                self._slots.put(_StreamSlot(self.engine, self.input_name, self.output_name, in_shape, out_shape))
+        finally:
+            self._cuda_ctx.pop()
+
+    def empty_batch(self) -> np.ndarray:
+        """
+        A page-locked float32 (max_batch, 224, 224, 3) buffer for the caller to
+        assemble batches in; predict() DMAs slices of it straight to the device.
+        """
+        self._cuda_ctx.push()
+        try:
+            buf = cuda.pagelocked_empty(self._in_shape, np.float32)
+        finally:
+            self._cuda_ctx.pop()
+        self._pinned_ranges.append((buf.ctypes.data, buf.ctypes.data + buf.nbytes))
+        return buf
+
+    def _is_pinned(self, x: np.ndarray) -> bool:
+        if x.dtype != np.float32 or not x.flags.c_contiguous:
+            return False
+        start = x.ctypes.data
+        return any(lo <= start and start + x.nbytes <= hi for lo, hi in self._pinned_ranges)
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        """(N, 224, 224, 3) pixels -> float32 (N, classes); N <= max_batch."""
+        n = x.shape[0]
+        if n > self.max_batch:
+            raise ValueError(f"Batch of {n} exceeds engine max batch {self.max_batch}")
+
+        # blocks only when num_streams batches are already on the GPU
+        slot = self._slots.get()
+        self._cuda_ctx.push()
+        try:
+            if self._is_pinned(x):
+                host_in = x
+            else:
+                host_in = slot.host_in[:n]
+                host_in[...] = x
+            host_out = slot.host_out[:n]
+            slot.context.set_input_shape(self.input_name, host_in.shape)
+            cuda.memcpy_htod_async(slot.dev_in, host_in, slot.stream)
+            slot.context.execute_async_v3(slot.stream.handle)
+            cuda.memcpy_dtoh_async(host_out, slot.dev_out, slot.stream)
+            slot.done.record(slot.stream)
+            # wait for this batch only; other slots keep running
+            slot.done.synchronize()
+            return host_out.copy()
+        finally:
+            self._cuda_ctx.pop()
+            self._slots.put(slot)